@@ -15,21 +15,22 @@
 
 from __future__ import absolute_import
 
+import concurrent.futures
 import datetime
 import logging
-import pathlib
 import re
-import json
-from typing import Any, Callable, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 import apache_beam as beam
+from apache_beam.io.filesystem import CompressedFile, CompressionTypes, FileMetadata
+from apache_beam.io.filesystems import FileSystems
 from apache_beam.io.gcp.gcsfilesystem import GCSFileSystem
 from apache_beam.io.fileio import WriteToFiles
 from apache_beam.options.pipeline_options import PipelineOptions
 from apache_beam.options.pipeline_options import SetupOptions
 from google.cloud import bigquery as cloud_bigquery  # type: ignore
 
-from pipeline.metadata.schema import BigqueryRow, dict_to_gcs_json_string
+from pipeline.metadata.schema import BigqueryRow, dict_to_gcs_json_bytes
 from pipeline.metadata import hyperquack
 from pipeline.metadata import schema
 from pipeline.metadata import flatten_base
@@ -61,10 +62,31 @@ SCAN_FILES = ['results.json']
 # An empty json file is 0 bytes when unzipped, but 33 bytes when zipped
 EMPTY_GZIPPED_FILE_SIZE = 33
 
+# Batching limits for bigquery file loads, pinned to Beam's current
+# defaults (4TB staged files, 20 concurrent writers per worker) so SDK
+# upgrades don't silently change staging behavior.
+BQ_MAX_FILE_SIZE = 4 * 1024 * 1024 * 1024 * 1024  # 4TB
+BQ_MAX_FILES_PER_BUNDLE = 20
+
+# Filenames contain dates like 'CP_Quack-http-2020-05-11-01-02-08'
+# Compiled once since _between_dates runs for every candidate file.
+FILENAME_DATE_REGEX = re.compile(r'\d\d\d\d-\d\d-\d\d')
+
+# Read buffer size when streaming scan files.
+# The 16KB default in CompressedFile makes reading
+# large gzipped files from GCS RPC-bound.
+SCAN_FILE_READ_SIZE = 16 * 1024 * 1024
+
 # We don't include data before this data in satellite
 # since it's not very accurate and causes scaling problems
 DONT_READ_SATELLITE_DATA_BEFORE = datetime.date(2022, 5, 1)
 
+# There is no scan data from before this year.
+EARLIEST_SCAN_YEAR = 2018
+
+# Number of file-matching requests to make in parallel.
+MATCH_THREADS = 8
+
 
 def _get_existing_bq_datasources(table_name: str, project: str) -> List[str]:
   """Given a BigQuery table return all sources that contributed to the table.
@@ -116,18 +138,51 @@ def _get_existing_gcs_datasources(gcs_folder: str, project: str) -> List[str]:
   folder = path_split[1] if len(path_split) > 1 else None
 
   # We expect filenames in format gs://bucket/.../source={source}/.../file
+  # The source= folders are direct children of the output folder,
+  # so list them as delimited prefixes instead of listing every object,
+  # which can take minutes for folders with millions of files.
   bucket = client.get_bucket(bucket_name)
-  matches = [
-      re.findall(r'source=[^/]*', file.name)
-      for file in client.list_blobs(bucket, prefix=folder)
-  ]
-  sources = [match[0][7:] for match in matches if match]
+  prefix = f'{folder}/' if folder else None
+  blobs = client.list_blobs(
+      bucket, prefix=prefix, delimiter='/', fields='prefixes,nextPageToken')
+
+  sources = []
+  for page in blobs.pages:
+    for subfolder in page.prefixes:
+      # subfolder is like 'avirkud/echo/source=CP_Quack-echo-2020-08-23-06-01-02/'
+      if 'source=' in subfolder:
+        sources.append(subfolder.rstrip('/').rpartition('source=')[2])
   return sources
 
 
-def _make_tuple(line: str, filename: str) -> Tuple[str, str]:
-  """Helper method for making a tuple from two args."""
-  return (filename, line)
+def _read_scan_lines(filename: str) -> Iterator[Tuple[str, str]]:
+  """Read in all lines of a (possibly compressed) scan file.
+
+  Args:
+    filename: a local or gcs filepath like
+      "gs://firehook-scans/http/CP_Quack-http-2020-05-11-01-02-08/results.json"
+
+  Yields:
+    Tuples of (filename, line)
+  """
+  raw_file = FileSystems.open(
+      filename, compression_type=CompressionTypes.UNCOMPRESSED)
+
+  compression_type = CompressionTypes.detect_compression_type(filename)
+  if compression_type == CompressionTypes.UNCOMPRESSED:
+    f = raw_file
+  else:
+    f = CompressedFile(raw_file, compression_type, read_size=SCAN_FILE_READ_SIZE)
+
+  while True:
+    line = f.readline()
+    if not line:
+      f.close()
+      return
+    # Remove the newline char
+    if line[-1:] == b'\n':
+      line = line[:-1]
+    yield (filename, str(line, 'utf-8'))
 
 
 def _read_scan_text(
@@ -148,7 +203,8 @@ def _read_scan_text(
 
   # PCollection[Tuple(filename, line)]
   lines = (
-      pfilenames | "read files" >> beam.io.ReadAllFromText(with_filename=True))
+      pfilenames | "read files" >>
+      beam.FlatMap(_read_scan_lines).with_output_types(Tuple[str, str]))
 
   return lines
 
@@ -168,7 +224,7 @@ def _between_dates(filename: str,
     boolean
   """
   date = datetime.date.fromisoformat(
-      re.findall(r'\d\d\d\d-\d\d-\d\d', filename)[0])
+      FILENAME_DATE_REGEX.search(filename).group(0))  # type: ignore[union-attr]
   if start_date and end_date:
     return start_date <= date <= end_date
   if start_date:
@@ -190,10 +246,12 @@ def _filename_matches(filepath: str, allowed_filenames: List[str]) -> bool:
     boolean, whether the filepath matches one of the list.
     Zipped matches to unzipped names count.
   """
-  filename = pathlib.PurePosixPath(filepath).name
+  # Plain string ops, since PurePosixPath construction is too heavy
+  # for a predicate that runs once per candidate file.
+  filename = filepath.rsplit('/', 1)[-1]
 
-  if '.gz' in pathlib.PurePosixPath(filename).suffixes:
-    filename = pathlib.PurePosixPath(filename).stem
+  if filename.endswith('.gz'):
+    filename = filename[:-len('.gz')]
 
   return filename in allowed_filenames
 
@@ -294,6 +352,44 @@ def get_gcs_folder(dataset_name: str, scan_type: str, bucket_name: str) -> str:
   return f'gs://{bucket_name}/{dataset_name}/{scan_type}'
 
 
+def _match_scan_files(
+    gcs: GCSFileSystem, input_bucket: str, scan_type: str,
+    start_date: Optional[datetime.date],
+    end_date: Optional[datetime.date]) -> List[FileMetadata]:
+  """Enumerate scan file metadata, matching in parallel by year.
+
+  A single recursive match under the scan folder blocks startup for
+  minutes on the larger scan types, so fan out one match per year of
+  data. The scan folder names all embed their date, like
+  'CP_Quack-http-2020-05-11-01-02-08'.
+
+  Args:
+    gcs: GCSFileSystem object
+    input_bucket: gcs folder like 'gs://firehook-scans/'
+    scan_type: one of 'echo', 'discard', 'http', 'https', 'satellite'
+    start_date: date object or None, only used to narrow the years matched
+    end_date: date object or None, only used to narrow the years matched
+
+  Returns:
+    A list of FileMetadata for all files under the scan type folder.
+  """
+  first_year = start_date.year if start_date else EARLIEST_SCAN_YEAR
+  last_year = end_date.year if end_date else datetime.date.today().year
+
+  # Filepaths like `gs://firehook-scans/echo/*-2020-*/**'
+  match_patterns = [
+      f'{input_bucket}{scan_type}/*-{year}-*/**'
+      for year in range(first_year, last_year + 1)
+  ]
+
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=MATCH_THREADS) as executor:
+    match_results = executor.map(
+        lambda pattern: gcs.match([pattern])[0].metadata_list, match_patterns)
+
+  return [metadata for result in match_results for metadata in result]
+
+
 def _raise_exception_if_zero(num: int) -> None:
   if num == 0:
     raise Exception("Zero rows were created even though there were new files.")
@@ -307,14 +403,33 @@ def _raise_error_if_collection_empty(
   return count_collection
 
 
-def _get_destination(record: str) -> str:
-  """Returns the hive-format dest folder for a measurement record str."""
-  record_dict = json.loads(record)
+def _get_destination(record_dict: Dict[str, Any]) -> str:
+  """Returns the hive-format dest folder for a measurement record dict."""
   if 'server_country' in record_dict:
     return f'source={record_dict["source"]}/country={record_dict["server_country"]}/results'
   return f'source={record_dict["source"]}/country={record_dict["resolver_country"]}/results'
 
 
+def _row_to_destination_and_json(
+    row: BigqueryRow, flatten_fn: Callable[[BigqueryRow],
+                                           Dict[str,
+                                                Any]]) -> Tuple[str, bytes]:
+  """Convert a row into its dest folder and serialized json in one step.
+
+  Fused into a single function so the intermediate dict never crosses a
+  stage boundary and pays Beam's per-element coder cost.
+
+  Args:
+    row: BigqueryRow of data to write.
+    flatten_fn: scan-type-specialized flattener from get_flatten_to_dict_fn
+
+  Returns:
+    Tuple of (destination folder, json bytes)
+  """
+  record_dict = flatten_fn(row)
+  return (_get_destination(record_dict), dict_to_gcs_json_bytes(record_dict))
+
+
 def _custom_file_naming(suffix: Optional[str] = None) -> Callable:
   """Returns custom function to name destination files."""
 
@@ -414,23 +529,25 @@ class ScanDataBeamPipelineRunner():
     else:
       files_to_load = SCAN_FILES
 
-    # Filepath like `gs://firehook-scans/echo/**/*'
-    files_regex = f'{self.input_bucket}{scan_type}/**/*'
-    file_metadata = [m.metadata_list for m in gcs.match([files_regex])][0]
-
-    filepaths = [metadata.path for metadata in file_metadata]
-    file_sizes = [metadata.size_in_bytes for metadata in file_metadata]
-
     if scan_type == 'satellite':
       if start_date is None or start_date < DONT_READ_SATELLITE_DATA_BEFORE:
         start_date = DONT_READ_SATELLITE_DATA_BEFORE
 
+    file_metadata = _match_scan_files(gcs, self.input_bucket, scan_type,
+                                      start_date, end_date)
+
+    # This filter can run over millions of files on a full reload,
+    # so filter in a single pass with O(1) source membership checks
+    # and the cheapest, most selective predicates first.
+    existing_sources_set = frozenset(existing_sources)
+
     filtered_filenames = [
-        filepath for (filepath, file_size) in zip(filepaths, file_sizes)
-        if (_between_dates(filepath, start_date, end_date) and
-            _filename_matches(filepath, files_to_load) and
-            flatten_base.source_from_filename(filepath) not in existing_sources
-            and file_size > EMPTY_GZIPPED_FILE_SIZE)
+        metadata.path for metadata in file_metadata
+        if (metadata.size_in_bytes > EMPTY_GZIPPED_FILE_SIZE and
+            _filename_matches(metadata.path, files_to_load) and
+            _between_dates(metadata.path, start_date, end_date) and
+            flatten_base.source_from_filename(metadata.path) not in
+            existing_sources_set)
     ]
 
     return filtered_filenames
@@ -461,15 +578,20 @@ class ScanDataBeamPipelineRunner():
       write_mode = beam.io.BigQueryDisposition.WRITE_TRUNCATE
 
     # Pcollection[Dict[str, Any]]
+    # The flattener is specialized for the scan type at construction time
+    # to avoid per-row type dispatch.
     dict_rows = (
         rows | f'dataclass to dicts {scan_type}' >> beam.Map(
-            schema.flatten_to_dict).with_output_types(Dict[str, Any]))
+            schema.get_flatten_to_dict_fn(scan_type)).with_output_types(
+                Dict[str, Any]))
 
     (dict_rows | f'Write {scan_type}' >> beam.io.WriteToBigQuery(  # pylint: disable=expression-not-assigned
         self._get_full_table_name(table_name),
         schema=bq_schema,
         create_disposition=beam.io.BigQueryDisposition.CREATE_IF_NEEDED,
         write_disposition=write_mode,
+        max_file_size=BQ_MAX_FILE_SIZE,
+        max_files_per_bundle=BQ_MAX_FILES_PER_BUNDLE,
         additional_bq_parameters=_get_partition_params(scan_type)))
 
   def _write_to_gcs(self, scan_type: str,
@@ -490,20 +612,20 @@ class ScanDataBeamPipelineRunner():
     Raises:
       Exception: if any arguments are invalid.
     """
-    # Pcollection[Dict[str, Any]]
-    dict_rows = (
-        rows | f'dataclass to dicts {scan_type}' >> beam.Map(
-            schema.flatten_to_dict).with_output_types(Dict[str, Any]))
-
-    # PCollection[str]
+    # The flatten/destination/serialize steps are fused into a single stage,
+    # and the destination is computed from the dict before serialization
+    # so we never have to re-parse the json to find it.
+    # PCollection[Tuple[destination,json]]
     json_rows = (
-        dict_rows | 'dicts to json' >>
-        beam.Map(dict_to_gcs_json_string).with_output_types(str))
+        rows | f'rows to json {scan_type}' >> beam.Map(
+            _row_to_destination_and_json,
+            flatten_fn=schema.get_flatten_to_dict_fn(scan_type)
+        ).with_output_types(Tuple[str, bytes]))
 
     # Set shards=1 and max_writers_per_bundle=0 to avoid sharding output.
     (json_rows | 'Write to GCS files' >> WriteToFiles(  # pylint: disable=expression-not-assigned
         path=gcs_folder,
-        destination=_get_destination,
+        destination=lambda row: row[0],
         sink=lambda dest: sink.JsonGzSink(),
         shards=1,
         max_writers_per_bundle=0,
@@ -585,13 +707,22 @@ class ScanDataBeamPipelineRunner():
       # PCollection[Tuple[filename,line]]
       lines = _read_scan_text(p, new_filenames)
 
+      # Incremental loads have few enough distinct (date, ip) pairs to
+      # broadcast ip metadata as a side input; full reloads fall back
+      # to a CoGroupByKey join with no worker-memory bound.
       if scan_type == schema.SCAN_TYPE_SATELLITE:
         # PCollection[SatelliteRow]
-        rows = satellite.process_satellite_lines(lines, self.metadata_adder)
+        rows = satellite.process_satellite_lines(
+            lines,
+            self.metadata_adder,
+            broadcast_ip_metadata=incremental_load)
 
       else:  # Hyperquack scans
         # PCollection[HyperquackRow]
-        rows = hyperquack.process_hyperquack_lines(lines, self.metadata_adder)
+        rows = hyperquack.process_hyperquack_lines(
+            lines,
+            self.metadata_adder,
+            broadcast_ip_metadata=incremental_load)
 
       _raise_error_if_collection_empty(rows)
 
@@ -3,19 +3,21 @@
 from __future__ import absolute_import
 
 import datetime
-from typing import List, Tuple, Iterator, Iterable
-import uuid
+import os
+from typing import Dict, List, Tuple, Iterator, Iterable
 
 import apache_beam as beam
 
 from pipeline.metadata.beam_metadata import DateIpKey, IP_METADATA_PCOLLECTION_NAME, ROWS_PCOLLECION_NAME, RECEIVED_IPS_PCOLLECTION_NAME, make_date_ip_key, merge_metadata_with_rows, merge_tagged_answers_with_rows, merge_satellite_metadata_with_answers
-from pipeline.metadata.schema import BigqueryRow, IpMetadataWithDateKey, SatelliteRow, SatelliteAnswer, SatelliteAnswerWithDateKey
-from pipeline.metadata.ip_metadata_chooser import IpMetadataChooserFactory
+from pipeline.metadata.schema import BigqueryRow, IpMetadataWithDateKey, SatelliteRow, SatelliteAnswer, SatelliteAnswerWithDateKey, merge_ip_metadata
+from pipeline.metadata.ip_metadata_chooser import IpMetadataChooser, IpMetadataChooserFactory
 
 
 def set_random_roundtrip_id(row: SatelliteRow) -> Tuple[str, SatelliteRow]:
   """Add a roundtrip_id field to a row."""
-  roundtrip_id = uuid.uuid4().hex
+  # The id is only used as an opaque join key,
+  # so random bytes are faster than constructing a full uuid4.
+  roundtrip_id = os.urandom(16).hex()
   return (roundtrip_id, row)
 
 
@@ -46,20 +48,82 @@ def _get_received_ips_with_roundtrip_id_and_date(
     yield (key, (roundtrip_id, answer))
 
 
+def _merge_metadata_into_row(
+    row_with_key: Tuple[DateIpKey, BigqueryRow],
+    metadata_by_key: Dict[DateIpKey, IpMetadataWithDateKey]) -> BigqueryRow:
+  """Merge a row with its corresponding metadata from a side-input dict.
+
+  Args:
+    row_with_key: Tuple of (DateIpKey, BigqueryRow)
+    metadata_by_key: Dict of DateIpKey to metadata, passed as a side input
+
+  Returns:
+    The row with any matching metadata columns added.
+  """
+  (key, row) = row_with_key
+  ip_metadata = metadata_by_key.get(key)
+  if ip_metadata is not None:
+    merge_ip_metadata(row.ip_metadata, ip_metadata)
+  return row
+
+
+def _deduplicate_date_ip_keys(
+    keys: beam.pvalue.PCollection[DateIpKey],
+    step_suffix: str) -> beam.pvalue.PCollection[DateIpKey]:
+  """Deduplicate DateIpKeys using a combiner instead of beam.Distinct.
+
+  CombinePerKey supports combiner lifting, which collapses duplicate keys
+  worker-side before the shuffle, while Distinct shuffles every element.
+
+  Args:
+    keys: PCollection of DateIpKeys, with duplicates
+    step_suffix: a suffix to keep beam step names unique
+
+  Returns:
+    PCollection of distinct DateIpKeys
+  """
+  return (
+      keys | f'pair keys for dedup {step_suffix}' >> beam.Map(
+          lambda key: (key, 1)).with_output_types(Tuple[DateIpKey, int]) |
+      f'combine duplicate keys {step_suffix}' >> beam.CombinePerKey(min) |
+      f'drop dedup counts {step_suffix}' >>
+      beam.Keys().with_output_types(DateIpKey))
+
+
 class MetadataAdder():
   """This class exists to provide access to the instantiated IpMetadata inside a beam operation."""
 
   def __init__(self,
                metadata_chooser_factory: IpMetadataChooserFactory) -> None:
     self.metadata_chooser_factory = metadata_chooser_factory
+    # Cache of date -> chooser so the underlying CAIDA/DBIP tables
+    # are only loaded once per date on each worker, not once per bundle.
+    # There are only a few hundred distinct dates per pipeline run.
+    self._chooser_cache: Dict[str, IpMetadataChooser] = {}
+
+  def _get_chooser(self, date: str) -> IpMetadataChooser:
+    """Get a cached metadata chooser for a 'YYYY-MM-DD' date key."""
+    chooser = self._chooser_cache.get(date)
+    if chooser is None:
+      chooser = self.metadata_chooser_factory.make_chooser(
+          datetime.date.fromisoformat(date))
+      self._chooser_cache[date] = chooser
+    return chooser
 
   def annotate_row_ip(
-      self, rows: beam.pvalue.PCollection[BigqueryRow]
+      self,
+      rows: beam.pvalue.PCollection[BigqueryRow],
+      broadcast_join: bool = True
   ) -> beam.pvalue.PCollection[BigqueryRow]:
     """Add ip metadata to a collection of roundtrip rows.
 
     Args:
       rows: beam.PCollection[BigqueryRow]
+      broadcast_join: if True, join metadata onto rows map-side via a
+        side-input dict, which requires all distinct (date, ip) metadata
+        entries to fit in worker memory. Incremental loads easily fit;
+        full reloads should pass False to join with an unbounded
+        CoGroupByKey shuffle instead.
 
     Returns:
       PCollection[BigqueryRow]
@@ -79,31 +143,41 @@ class MetadataAdder():
         beam.Keys().with_output_types(DateIpKey))
 
     # PCollection[DateIpKey]
-    deduped_ips_and_dates = (
-        # pylint: disable=no-value-for-parameter
-        ips_and_dates | 'dedup' >> beam.Distinct().with_output_types(DateIpKey))
-
-    # PCollection[Tuple[date,List[ip]]]
-    grouped_ips_by_dates = (
-        deduped_ips_and_dates | 'group by date' >>
-        beam.GroupByKey().with_output_types(Tuple[str, Iterable[str]]))
+    deduped_ips_and_dates = _deduplicate_date_ip_keys(ips_and_dates, 'rows')
 
+    # Batch the distinct keys worker-side rather than shuffling them into
+    # per-date groups; the per-date GroupByKey was heavily skewed since a
+    # few dates dominate, and the chooser cache already amortizes loading
+    # the metadata sources per date.
     # PCollection[Tuple[DateIpKey,IpMetadataWithDateKey]]
     ips_with_metadata = (
-        grouped_ips_by_dates | 'get ip metadata' >> beam.FlatMapTuple(
-            self._annotate_ips).with_output_types(Tuple[DateIpKey,
-                                                        IpMetadataWithDateKey]))
-
-    # PCollection[Tuple[Tuple[date,ip],Dict[input_name_key,List[BigqueryRow|IpMetadataWithDateKey]]]]
-    grouped_metadata_and_rows = (({
-        IP_METADATA_PCOLLECTION_NAME: ips_with_metadata,
-        ROWS_PCOLLECION_NAME: rows_keyed_by_ip_and_date
-    }) | 'group by keys' >> beam.CoGroupByKey())
+        deduped_ips_and_dates |
+        'batch ips' >> beam.BatchElements(max_batch_size=10000) |
+        'get ip metadata' >> beam.FlatMap(self._annotate_ips).with_output_types(
+            Tuple[DateIpKey, IpMetadataWithDateKey]))
 
-    # PCollection[BigqueryRow]
-    rows_with_metadata = (
-        grouped_metadata_and_rows | 'merge metadata with rows' >>
-        beam.FlatMapTuple(merge_metadata_with_rows))
+    if broadcast_join:
+      # The metadata has one entry per distinct (date, ip) so it is small
+      # relative to the rows. Broadcast it as a side-input dict and join
+      # map-side instead of paying a second full CoGroupByKey shuffle.
+      # PCollection[BigqueryRow]
+      # The explicit Any output type keeps beam from inferring
+      # BigqueryRow from the merge function's annotation.
+      rows_with_metadata = (
+          rows_keyed_by_ip_and_date | 'merge metadata with rows' >> beam.Map(
+              _merge_metadata_into_row,
+              metadata_by_key=beam.pvalue.AsDict(ips_with_metadata)).
+          with_output_types(beam.typehints.Any))
+    else:
+      grouped_metadata_and_rows = (({
+          IP_METADATA_PCOLLECTION_NAME: ips_with_metadata,
+          ROWS_PCOLLECION_NAME: rows_keyed_by_ip_and_date
+      }) | 'add metadata: group by keys' >> beam.CoGroupByKey())
+
+      # PCollection[BigqueryRow]
+      rows_with_metadata = (
+          grouped_metadata_and_rows | 'merge metadata with rows' >>
+          beam.FlatMapTuple(merge_metadata_with_rows))
     # We had to remove the beam type hint here
     # So subsequent operations can take either HyperquackRow or SatelliteRow
 
@@ -140,21 +214,15 @@ class MetadataAdder():
         beam.Keys().with_output_types(DateIpKey))
 
     # PCollection[DateIpKey]
-    deduped_ips_and_dates = (
-        # pylint: disable=no-value-for-parameter
-        ips_and_dates |
-        'dedup answer ips' >> beam.Distinct().with_output_types(DateIpKey))
-
-    # PCollection[Tuple[date,List[ip]]]
-    grouped_ips_by_dates = (
-        deduped_ips_and_dates | 'group answer ips by date' >>
-        beam.GroupByKey().with_output_types(Tuple[str, Iterable[str]]))
+    deduped_ips_and_dates = _deduplicate_date_ip_keys(ips_and_dates, 'answers')
 
     # PCollection[Tuple[DateIpKey,IpMetadataWithDateKey]]
     ips_with_metadata = (
-        grouped_ips_by_dates | 'get ip metadata for answers' >>
-        beam.FlatMapTuple(self._annotate_ips).with_output_types(
-            Tuple[DateIpKey, IpMetadataWithDateKey]))
+        deduped_ips_and_dates |
+        'batch answer ips' >> beam.BatchElements(max_batch_size=10000) |
+        'get ip metadata for answers' >> beam.FlatMap(
+            self._annotate_ips).with_output_types(Tuple[DateIpKey,
+                                                        IpMetadataWithDateKey]))
 
     grouped_metadata_and_received_ips = (({
         IP_METADATA_PCOLLECTION_NAME: ips_with_metadata,
@@ -189,22 +257,18 @@ class MetadataAdder():
     return rows_with_metadata
 
   def _annotate_ips(
-      self, date: str,
-      ips: List[str]) -> Iterator[Tuple[DateIpKey, IpMetadataWithDateKey]]:
-    """Add Autonymous System metadata for ips in the given rows.
+      self, keys: List[DateIpKey]
+  ) -> Iterator[Tuple[DateIpKey, IpMetadataWithDateKey]]:
+    """Add Autonymous System metadata for a batch of (date, ip) keys.
 
     Args:
-      date: a 'YYYY-MM-DD' date key
-      ips: a list of ips
+      keys: a batch of ('YYYY-MM-DD', ip) keys
 
     Yields:
       Tuples (DateIpKey, IpMetadataWithDateKey)
     """
-    ip_metadata_chooser = self.metadata_chooser_factory.make_chooser(
-        datetime.date.fromisoformat(date))
-
-    for ip in ips:
-      metadata_key = (date, ip)
+    for (date, ip) in keys:
+      ip_metadata_chooser = self._get_chooser(date)
       metadata_values = ip_metadata_chooser.get_metadata(ip)
 
-      yield (metadata_key, metadata_values)
+      yield ((date, ip), metadata_values)
@@ -2,12 +2,13 @@
 
 from __future__ import absolute_import
 
-import json
+import hashlib
 import logging
 from typing import Tuple, Iterator
 import uuid
 
 import apache_beam as beam
+import orjson
 
 from pipeline.metadata.schema import BigqueryRow
 from pipeline.metadata.blockpage import BlockpageMatcher
@@ -19,6 +20,29 @@ from pipeline.metadata.flatten_hyperquack import HyperquackFlattener
 CENSORED_PLANET_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_DNS, "censoredplanet.org")
 
 
+def _make_measurement_id(filename: str, line: str) -> str:
+  """Make a deterministic hex id for a measurement.
+
+  Identical to uuid.uuid5(CENSORED_PLANET_NAMESPACE, filename + line).hex
+  but skips the UUID object construction, which is a measurable per-line cost.
+
+  Args:
+    filename: a filepath string
+    line: a json measurement string
+
+  Returns:
+    a 32 char hex string
+  """
+  digest = bytearray(
+      hashlib.sha1(CENSORED_PLANET_NAMESPACE.bytes +
+                   (filename + line).encode('utf-8')).digest()[:16])
+  # Set the uuid5 version and variant bits so ids stay stable
+  # across this and the previous uuid-based implementation.
+  digest[6] = (digest[6] & 0x0F) | 0x50
+  digest[8] = (digest[8] & 0x3F) | 0x80
+  return digest.hex()
+
+
 class FlattenMeasurement(beam.DoFn):
   """DoFn class for flattening lines of json text into BigqueryRow."""
 
@@ -55,14 +79,16 @@ class FlattenMeasurement(beam.DoFn):
 
     # pylint: disable=too-many-branches
     try:
-      scan = json.loads(line)
-    except json.decoder.JSONDecodeError as e:
+      # orjson is much faster than the stdlib json parser
+      # and parsing is the dominant per-line cost in this DoFn.
+      scan = orjson.loads(line)
+    except orjson.JSONDecodeError as e:
       logging.warning('JSONDecodeError: %s\nFilename: %s\n%s\n', e, filename,
                       line)
       return
 
     # Add a unique id per-measurement so single retry rows can be reassembled
-    measurement_id = uuid.uuid5(CENSORED_PLANET_NAMESPACE, filename + line).hex
+    measurement_id = _make_measurement_id(filename, line)
 
     if SATELLITE_PATH_COMPONENT in filename:
       yield from self.satellite_flattener.process_satellite(
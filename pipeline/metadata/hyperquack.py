@@ -41,7 +41,9 @@ def _add_outcome(row: HyperquackRow) -> HyperquackRow:
 
 def process_hyperquack_lines(
     lines: beam.pvalue.PCollection[Tuple[str, str]],
-    metadata_adder: MetadataAdder) -> beam.pvalue.PCollection[HyperquackRow]:
+    metadata_adder: MetadataAdder,
+    broadcast_ip_metadata: bool = True
+) -> beam.pvalue.PCollection[HyperquackRow]:
   """Process hyperquack data."""
 
   # PCollection[HyperquackRow]
@@ -50,7 +52,8 @@ def process_hyperquack_lines(
           flatten.FlattenMeasurement()).with_output_types(HyperquackRow))
 
   # PCollection[HyperquackRow]
-  rows_with_ip_annotations = metadata_adder.annotate_row_ip(rows)
+  rows_with_ip_annotations = metadata_adder.annotate_row_ip(
+      rows, broadcast_join=broadcast_ip_metadata)
 
   # PCollection[HyperquackRow]
   rows_with_outcomes = (
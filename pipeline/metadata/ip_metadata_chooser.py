@@ -78,7 +78,7 @@ class IpMetadataChooserFactory():
     caida_db = caida_ip_metadata.CaidaIpMetadata(date, self.caida_file_location,
                                                  True)
     # TODO turn back on when using maxmind again.
-    # maxmind = maxmind.MaxmindIpMetadata(self.maxmind_file_location)
+    # maxmind_db = maxmind.MaxmindIpMetadata.get(self.maxmind_file_location)
     dbip_db = dbip.DbipMetadata(self.dbip_file_location)
 
     return IpMetadataChooser(date, caida_db, dbip_db)
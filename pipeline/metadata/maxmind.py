@@ -1,16 +1,45 @@
 """Module to initialize Maxmind databases and lookup IP metadata."""
 
+import collections
+import concurrent.futures
+import ipaddress
 import logging
 import os
-from typing import Optional, Tuple, NamedTuple
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple, NamedTuple, Union, cast
 
-import geoip2.database
+import maxminddb
 
-from pipeline.metadata.mmdb_reader import mmdb_reader
+from pipeline.metadata.mmdb_reader import mmdb_raw_reader
 
 MAXMIND_CITY = 'GeoLite2-City.mmdb'
 MAXMIND_ASN = 'GeoLite2-ASN.mmdb'
 
+# Cache of maxmind_folder -> (city reader, asn reader) so each worker only
+# pays the mmdb download and parse cost once, not once per beam bundle.
+# Readers are read-only and safe to share across threads.
+_READER_CACHE: Dict[str, Tuple[maxminddb.reader.Reader,
+                               maxminddb.reader.Reader]] = {}
+_READER_CACHE_LOCK = threading.Lock()
+
+# Per-process singletons keyed by maxmind_folder. Beam may construct
+# DoFns once per bundle or thread; sharing one instance per process
+# also shares its lookup caches.
+_METADATA_CACHE: Dict[str, 'MaxmindIpMetadata'] = {}
+_METADATA_CACHE_LOCK = threading.Lock()
+
+# Scans revisit the same vantage point ips millions of times,
+# so memoize lookups. Bounded to keep worker memory reasonable.
+LOOKUP_CACHE_SIZE = 1 << 20
+
+# lookup_many fans out across this many threads. The maxminddb C
+# extension releases the GIL during the trie walk, so batched lookups
+# run in parallel with each other and with downstream sink I/O.
+LOOKUP_THREADS = os.cpu_count() or 4
+
+# A pre-parsed ip address, accepted directly by the maxminddb readers.
+ParsedIp = Union[ipaddress.IPv4Address, ipaddress.IPv6Address]
+
 # Tuple(netblock, asn, as_name, country)
 # ex: ("1.0.0.1/24", 13335, "CLOUDFLARENET", "AU")
 MaxmindReturnValues = NamedTuple('MaxmindReturnValues',
@@ -32,8 +61,61 @@ class MaxmindIpMetadata():
     maxmind_city_path = os.path.join(maxmind_folder, MAXMIND_CITY)
     maxmind_asn_path = os.path.join(maxmind_folder, MAXMIND_ASN)
 
-    self.maxmind_city = mmdb_reader(maxmind_city_path)
-    self.maxmind_asn = mmdb_reader(maxmind_asn_path)
+    with _READER_CACHE_LOCK:
+      readers = _READER_CACHE.get(maxmind_folder)
+      if readers is None:
+        # Download the two databases in parallel,
+        # halving cold-start time on gcs-backed folders.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+          city_future = pool.submit(mmdb_raw_reader, maxmind_city_path)
+          asn_future = pool.submit(mmdb_raw_reader, maxmind_asn_path)
+          readers = (city_future.result(), asn_future.result())
+        _READER_CACHE[maxmind_folder] = readers
+
+    (self.maxmind_city, self.maxmind_asn) = readers
+
+    # Pre-bind the hot reader methods so each lookup skips the
+    # repeated self.reader.method attribute chain.
+    self._city_get_with_prefix_len = self.maxmind_city.get_with_prefix_len
+    self._asn_get_with_prefix_len = self.maxmind_asn.get_with_prefix_len
+
+    # The caches below are shared across lookup_many threads (and all
+    # DoFns holding the per-process instance), and OrderedDict is not
+    # safe to mutate concurrently, so all cache access holds this lock.
+    # The trie walks themselves run outside it.
+    self._cache_lock = threading.Lock()
+    # LRU cache of ip -> MaxmindReturnValues for repeat lookups.
+    self._lookup_cache: 'collections.OrderedDict[str, MaxmindReturnValues]' = (
+        collections.OrderedDict())
+    # Every ip in a prefix shares the same netblock string, so intern
+    # them keyed on (ip version, network address, prefix length).
+    # Bounded by the number of distinct prefixes in the asn database.
+    self._netblock_cache: Dict[Tuple[int, int, int], str] = {}
+    # Threads are only spawned when lookup_many is first used.
+    self._lookup_pool = concurrent.futures.ThreadPoolExecutor(
+        max_workers=LOOKUP_THREADS)
+    # Scans enumerate adjacent ips, so remember the last resolved
+    # block as (version, network address, prefix length, values) and
+    # reuse it for ips in the same prefix without walking the tries.
+    self._last_block: Optional[Tuple[int, int, int,
+                                     MaxmindReturnValues]] = None
+
+  @classmethod
+  def get(cls, maxmind_folder: str) -> 'MaxmindIpMetadata':
+    """Return the shared per-process instance for a maxmind folder.
+
+      Args:
+        maxmind_folder: a folder containing maxmind files.
+          Either a gcs filepath or a local system folder.
+
+      Returns: MaxmindIpMetadata
+    """
+    with _METADATA_CACHE_LOCK:
+      metadata = _METADATA_CACHE.get(maxmind_folder)
+      if metadata is None:
+        metadata = cls(maxmind_folder)
+        _METADATA_CACHE[maxmind_folder] = metadata
+      return metadata
 
   def lookup(self, ip: str) -> MaxmindReturnValues:
     """Lookup metadata infomation about an IP.
@@ -46,52 +128,148 @@ class MaxmindIpMetadata():
       Raises:
         KeyError: when the IP's ASN can't be found
     """
-    (asn, as_name, netblock) = self._get_maxmind_asn(ip)
-    country = self._get_country_code(ip)
+    try:
+      # Parse the ip once here instead of once per database,
+      # since the readers accept pre-parsed addresses.
+      parsed_ip = ipaddress.ip_address(ip)
+    except ValueError as e:
+      # Malformed ips can't have an entry. Log at debug level
+      # since warnings here can swamp the logs on large scans.
+      logging.debug('Maxmind: %s\n', e)
+      raise KeyError(f"No Maxmind entry for {ip}") from e
 
-    if not asn:
-      raise KeyError(f"No Maxmind entry for {ip}")
+    ip_int = int(parsed_ip)
+    max_prefixlen = parsed_ip.max_prefixlen
 
-    return MaxmindReturnValues(netblock, asn, as_name, country)
+    with self._cache_lock:
+      cached_values = self._lookup_cache.get(ip)
+      if cached_values is not None:
+        self._lookup_cache.move_to_end(ip)
+        return cached_values
 
-  def _get_country_code(self, vp_ip: str) -> Optional[str]:
-    """Get country code for IP address.
+      last = self._last_block
+      if last is not None:
+        (version, network_int, prefix_len, values) = last
+        if (parsed_ip.version == version and
+            ip_int >> (max_prefixlen - prefix_len) == network_int):
+          return values
+
+    (asn, as_name, netblock,
+     asn_prefix_len) = self._get_maxmind_asn(parsed_ip)
+    (country, city_prefix_len) = self._get_country_code(parsed_ip)
+
+    values = MaxmindReturnValues(netblock, asn, as_name, country)
+    # The values hold across the more specific of the two prefixes.
+    shared_prefix_len = max(asn_prefix_len, city_prefix_len)
+    with self._cache_lock:
+      self._last_block = (parsed_ip.version,
+                          ip_int >> (max_prefixlen - shared_prefix_len),
+                          shared_prefix_len, values)
+      self._lookup_cache[ip] = values
+      if len(self._lookup_cache) > LOOKUP_CACHE_SIZE:
+        self._lookup_cache.popitem(last=False)
+    return values
+
+  def lookup_many(
+      self, ips: Sequence[str]) -> List[Optional[MaxmindReturnValues]]:
+    """Lookup metadata for a batch of IPs in one call.
+
+      Batched lookups fan out over a thread pool so the trie walks,
+      which release the GIL in the maxminddb C extension, overlap
+      with each other and with downstream writes.
 
       Args:
-        vp_ip: IP address of vantage point (as string)
+        ips: IP strings of the format 1.1.1.1
 
       Returns:
-        2-letter ISO country code
+        A list with one MaxmindReturnValues per input ip,
+        or None for ips with no Maxmind entry.
     """
+    return list(self._lookup_pool.map(self._lookup_or_none, ips))
+
+  def _lookup_or_none(self, ip: str) -> Optional[MaxmindReturnValues]:
+    """Lookup an IP, returning None instead of raising on a miss."""
     try:
-      vp_info = self.maxmind_city.city(vp_ip)
-      return vp_info.country.iso_code
-    except (ValueError, geoip2.errors.AddressNotFoundError) as e:
-      logging.warning('Maxmind: %s\n', e)
-    return None
+      return self.lookup(ip)
+    except KeyError:
+      return None
+
+  def _get_country_code(self,
+                        vp_ip: ParsedIp) -> Tuple[Optional[str], int]:
+    """Get country code for IP address.
+
+      Args:
+        vp_ip: pre-parsed IP address of vantage point
+
+      Returns:
+        Tuple of the 2-letter ISO country code (or None on a miss)
+        and the prefix length the answer holds for
+    """
+    # The raw reader returns a plain dict, skipping the construction
+    # of the geoip2 model objects when only one field is needed.
+    # A miss returns None rather than raising, which avoids paying
+    # exception overhead for the many scan ips with no entry.
+    (rec, prefix_len) = self._city_get_with_prefix_len(vp_ip)
+    if rec is None:
+      return None, prefix_len
+    # maxminddb types records as a broad union,
+    # but top-level records are always dicts.
+    record = cast(Dict[str, Any], rec)
+    return record.get('country', {}).get('iso_code'), prefix_len
 
   def _get_maxmind_asn(
-      self, vp_ip: str) -> Tuple[Optional[int], Optional[str], Optional[str]]:
+      self, vp_ip: ParsedIp) -> Tuple[int, Optional[str], str, int]:
     """Get ASN information for IP address.
 
       Args:
-        vp_ip: IP address of vantage point (as string)
+        vp_ip: pre-parsed IP address of vantage point
+
+      Returns:
+        Tuple containing AS num, AS org, netblock,
+        and the prefix length the answer holds for
+
+      Raises:
+        KeyError: when the IP has no ASN entry
+    """
+    (rec, prefix_len) = self._asn_get_with_prefix_len(vp_ip)
+    if rec is None:
+      raise KeyError(f'No Maxmind entry for {vp_ip}')
+    record = cast(Dict[str, Any], rec)
+    # An explicit None check rather than truthiness, since ASN 0 is
+    # a legitimate value.
+    asn = record.get('autonomous_system_number')
+    if asn is None:
+      raise KeyError(f'No Maxmind entry for {vp_ip}')
+    as_name = record.get('autonomous_system_organization')
+    netblock = self._get_netblock(vp_ip, prefix_len)
+    return asn, as_name, netblock, prefix_len
+
+  def _get_netblock(self, vp_ip: ParsedIp, prefix_len: int) -> str:
+    """Get the interned netblock string containing an IP address.
+
+      Args:
+        vp_ip: pre-parsed IP address of vantage point
+        prefix_len: prefix length of the netblock containing the IP
 
       Returns:
-        Tuple containing AS num, AS org, and netblock
+        netblock string, ex: "1.0.0.0/24"
     """
-    try:
-      vp_info = self.maxmind_asn.asn(vp_ip)
-      asn = vp_info.autonomous_system_number
-      as_name = vp_info.autonomous_system_organization
-      if vp_info.network:
-        netblock: Optional[str] = vp_info.network.with_prefixlen
-      else:
-        netblock = None
-      return asn, as_name, netblock
-    except (ValueError, geoip2.errors.AddressNotFoundError) as e:
-      logging.warning('Maxmind: %s\n', e)
-    return None, None, None
+    network_int = int(vp_ip) >> (vp_ip.max_prefixlen - prefix_len)
+    key = (vp_ip.version, network_int, prefix_len)
+    with self._cache_lock:
+      netblock = self._netblock_cache.get(key)
+    if netblock is None:
+      netblock = str(
+          ipaddress.ip_network(f'{vp_ip}/{prefix_len}', strict=False))
+      with self._cache_lock:
+        netblock = self._netblock_cache.setdefault(key, netblock)
+    return netblock
+
+
+# Shared by every FakeMaxmindIpMetadata lookup instead of
+# constructing a fresh tuple per call.
+_FAKE_LOOKUP_RESULT = MaxmindReturnValues('101.103.0.0/16', 1221,
+                                          'ASN-TELSTRA', 'AU')
 
 
 class FakeMaxmindIpMetadata(MaxmindIpMetadata):
@@ -102,4 +280,4 @@ class FakeMaxmindIpMetadata(MaxmindIpMetadata):
     pass
 
   def lookup(self, _: str) -> MaxmindReturnValues:
-    return MaxmindReturnValues('101.103.0.0/16', 1221, 'ASN-TELSTRA', 'AU')
+    return _FAKE_LOOKUP_RESULT
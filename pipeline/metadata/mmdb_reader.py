@@ -1,14 +1,65 @@
 """Method to read in mmdb files"""
 
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
 import tempfile
 
 import geoip2.database
-from geoip2.database import MODE_MEMORY
+import maxminddb
 import apache_beam.io.filesystems as apache_filesystems
 
+# Stream downloads in 1MB chunks to avoid holding a whole
+# multi-hundred-MB database in memory at once.
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+
+def _local_mmdb_path(filepath: str) -> str:
+  """Returns the stable local path an mmdb file is downloaded to."""
+  filename = hashlib.sha1(filepath.encode('utf-8')).hexdigest() + '.mmdb'
+  return os.path.join(tempfile.gettempdir(), filename)
+
+
+def _download_mmdb(filepath: str) -> str:
+  """Download an mmdb file to a stable local path if not already present.
+
+    Args:
+      filepath: gcs or local fileststem path to .mmdb file
+
+    Returns:
+      local filesystem path to the downloaded file
+  """
+  # The file is downloaded to a stable on-disk path (once per machine)
+  # so the reader can mmap it instead of slurping the whole db into
+  # memory. All worker processes mmap the same inode, so the kernel
+  # keeps one physical copy of the database per machine.
+  local_path = _local_mmdb_path(filepath)
+  if os.path.exists(local_path):
+    return local_path
+
+  # Serialize the download across worker processes with a file lock
+  # so a machine downloads each database once, not once per process.
+  with open(local_path + '.lock', 'w') as lock_file:
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    try:
+      if not os.path.exists(local_path):
+        f = apache_filesystems.FileSystems.open(filepath)
+        # Write to a temp name and rename so concurrent readers
+        # can never see a partially-downloaded file.
+        (tmp_fd, tmp_path) = tempfile.mkstemp(dir=tempfile.gettempdir())
+        with os.fdopen(tmp_fd, 'wb') as disk_file:
+          shutil.copyfileobj(f, disk_file, DOWNLOAD_CHUNK_SIZE)
+        os.rename(tmp_path, local_path)
+    finally:
+      fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+  return local_path
+
 
 def mmdb_reader(filepath: str) -> geoip2.database.Reader:
-  """Return a reader for an MMDB database.
+  """Return a geoip2 reader for an MMDB database.
 
     Args:
       filepath: gcs or local fileststem path to .mmdb file
@@ -16,12 +67,33 @@ def mmdb_reader(filepath: str) -> geoip2.database.Reader:
     Returns:
       geoip2.database.Reader
   """
-  f = apache_filesystems.FileSystems.open(filepath)
-
-  # geoip2 reader will only take a filepath,
-  # so we need to write the file to local disk
-  with tempfile.NamedTemporaryFile() as disk_file:
-    disk_file.write(f.read())
-    disk_filename = disk_file.name
-    database = geoip2.database.Reader(disk_filename, mode=MODE_MEMORY)
-    return database
+  local_path = _download_mmdb(filepath)
+  # MODE_AUTO prefers the C extension's mmap mode (MODE_MMAP_EXT),
+  # which is much faster than the pure-python in-memory reader.
+  return geoip2.database.Reader(local_path, mode=maxminddb.MODE_AUTO)
+
+
+def mmdb_raw_reader(filepath: str) -> maxminddb.reader.Reader:
+  """Return a raw maxminddb reader for an MMDB database.
+
+    Unlike the geoip2 reader this returns plain dicts from lookups
+    instead of constructing model objects, which is much cheaper
+    for callers that only read a couple of fields.
+
+    Args:
+      filepath: gcs or local fileststem path to .mmdb file
+
+    Returns:
+      maxminddb.reader.Reader
+  """
+  local_path = _download_mmdb(filepath)
+  try:
+    # The libmaxminddb C extension walks the trie natively without
+    # constructing python objects per node, and mmaps the database
+    # rather than copying it into the heap.
+    return maxminddb.open_database(local_path, mode=maxminddb.MODE_MMAP_EXT)
+  except ValueError:
+    logging.warning(
+        'maxminddb C extension unavailable, '
+        'using the much slower pure-python reader for %s', filepath)
+    return maxminddb.open_database(local_path, mode=maxminddb.MODE_AUTO)
@@ -849,11 +849,16 @@ def _verify(scan: SatelliteRow) -> SatelliteRow:
 
 def process_satellite_lines(
     lines: beam.pvalue.PCollection[Tuple[str, str]],
-    metadata_adder: MetadataAdder) -> beam.pvalue.PCollection[SatelliteRow]:
+    metadata_adder: MetadataAdder,
+    broadcast_ip_metadata: bool = True
+) -> beam.pvalue.PCollection[SatelliteRow]:
   """Process both satellite and page fetch data files.
 
   Args:
     lines: input lines from all satellite files. Tuple[filename, line]
+    metadata_adder: adder for ip metadata
+    broadcast_ip_metadata: whether resolver ip metadata can be joined
+      via a broadcast side input, see MetadataAdder.annotate_row_ip
 
   Returns:
     post_processed_satellite: rows of satellite scan data
@@ -887,7 +892,7 @@ def process_satellite_lines(
 
   # PCollection[SatelliteRow]
   rows_with_resolver_ip_annotations = metadata_adder.annotate_row_ip(
-      resolver_tagged_satellite)
+      resolver_tagged_satellite, broadcast_join=broadcast_ip_metadata)
 
   # - join data onto answer ips
 
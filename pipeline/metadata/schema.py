@@ -4,9 +4,10 @@ from __future__ import absolute_import
 from __future__ import annotations  # required to use class as a type inside the class
 
 import dataclasses
-import json
 from dataclasses import dataclass
-from typing import Optional, List, Dict, Any, Union
+from typing import Callable, Optional, List, Dict, Any, Union
+
+import orjson
 
 from apache_beam.io.gcp.internal.clients import bigquery as beam_bigquery
 
@@ -256,6 +257,24 @@ def flatten_to_dict(row: Union[BigqueryRow, PageFetchRow]) -> Dict[str, Any]:
   raise Exception(f'Unknown row type: {type(row)}')
 
 
+def get_flatten_to_dict_fn(scan_type: str) -> Callable[..., Dict[str, Any]]:
+  """Get the row flattening function specialized for a scan type.
+
+  The scan type is fixed at pipeline construction time, so picking the
+  specialized flattener up front skips the per-row isinstance dispatch
+  in flatten_to_dict.
+
+  Args:
+    scan_type: one of 'echo', 'discard', 'http', 'https', or 'satellite'
+
+  Returns:
+    the matching flatten_to_dict_* function
+  """
+  if scan_type == SCAN_TYPE_SATELLITE:
+    return flatten_to_dict_satellite
+  return flatten_to_dict_hyperquack
+
+
 # yapf: disable
 def flatten_to_dict_hyperquack(row: HyperquackRow) -> Dict[str, Any]:
   """Convert a structured hyperquack dataclass into a flat dict."""
@@ -392,12 +411,15 @@ def flatten_to_dict_satellite(row: SatelliteRow) -> Dict[str, Any]:
   return flat
 
 
-def dict_to_gcs_json_string(measurement_dict: Dict[str, Any]) -> str:
-  """Convert dict of measurement data to json string with selected GCS fields."""
+def dict_to_gcs_json_bytes(measurement_dict: Dict[str, Any]) -> bytes:
+  """Convert dict of measurement data to json bytes with selected GCS fields.
+
+  Uses orjson since serialization runs once per output row.
+  """
   if 'Quack' in measurement_dict['source']:
-    return json.dumps(dict_to_gcs_dict_hyperquack(measurement_dict))
+    return orjson.dumps(dict_to_gcs_dict_hyperquack(measurement_dict))
   if 'Satellite' in measurement_dict['source']:
-    return json.dumps(dict_to_gcs_dict_satellite(measurement_dict))
+    return orjson.dumps(dict_to_gcs_dict_satellite(measurement_dict))
   raise Exception(f'Unknown dict source: {measurement_dict["source"]}')
 
 
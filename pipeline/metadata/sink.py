@@ -1,10 +1,26 @@
 """JsonGzSink class to handle writing to GCS files."""
 
-from typing import BinaryIO
+from typing import BinaryIO, Tuple
 
 from apache_beam.io.filesystem import CompressionTypes
 from apache_beam.io.fileio import FileMetadata, FileSink
-from apache_beam.coders import coders
+
+try:
+  # isal's SIMD-accelerated zlib is several times faster than stdlib zlib.
+  from isal import isal_zlib as zlib_impl
+except ImportError:
+  import zlib as zlib_impl  # type: ignore[no-redef]
+
+# Batch writes into 1MB chunks so the compressor handles
+# large blocks instead of paying per-record deflate/CRC overhead.
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Level 1 is fine for intermediate GCS storage and much faster than the
+# default level. Valid for both isal (0-3) and zlib (0-9).
+COMPRESSION_LEVEL = 1
+
+# wbits > 16 makes the deflate stream a gzip container.
+GZIP_WBITS = 16 + 15
 
 
 class JsonGzSink(FileSink):
@@ -12,25 +28,41 @@ class JsonGzSink(FileSink):
 
   def __init__(self) -> None:
     """Initialize a JsonGzSink."""
-    self.coder = coders.ToBytesCoder()
     self.file_handle: BinaryIO
+    self.buffer = bytearray()
+    # open() replaces this with a fresh compressor per file;
+    # initializing one here keeps the attribute correctly typed.
+    self.compressor = zlib_impl.compressobj(COMPRESSION_LEVEL,
+                                            zlib_impl.DEFLATED, GZIP_WBITS)
 
   def create_metadata(self, destination: str,
                       full_file_name: str) -> FileMetadata:
     """Returns the file metadata as tuple (mime_type, compression_type)."""
+    # Compression is done in this sink so we can use isal,
+    # rather than going through Beam's zlib-based gzip wrapper.
     return FileMetadata(
-        mime_type="application/json", compression_type=CompressionTypes.GZIP)
+        mime_type="application/json",
+        compression_type=CompressionTypes.UNCOMPRESSED)
 
   def open(self, fh: BinaryIO) -> None:
     """Prepares the sink file for writing."""
     self.file_handle = fh
+    self.buffer = bytearray()
+    self.compressor = zlib_impl.compressobj(COMPRESSION_LEVEL,
+                                            zlib_impl.DEFLATED, GZIP_WBITS)
 
-  def write(self, record: str) -> None:
-    """Writes a single record."""
-    self.file_handle.write(self.coder.encode(record) + b'\n')
+  def write(self, record: Tuple[str, bytes]) -> None:
+    """Writes a single Tuple[destination, json] record."""
+    self.buffer += record[1]
+    self.buffer += b'\n'
+    if len(self.buffer) >= WRITE_BUFFER_SIZE:
+      self.file_handle.write(self.compressor.compress(bytes(self.buffer)))
+      self.buffer.clear()
 
   def flush(self) -> None:
-    """Flushes the sink file."""
-    # This method must be implemented for FileSink subclasses,
-    # but calling self.file_handle.flush() here triggers a zlib error.
-    pass  # pylint: disable=unnecessary-pass
+    """Compresses and flushes any buffered records to the sink file."""
+    if self.buffer:
+      self.file_handle.write(self.compressor.compress(bytes(self.buffer)))
+      self.buffer.clear()
+    # Finalize the gzip stream (flush internal state and write the trailer).
+    self.file_handle.write(self.compressor.flush())
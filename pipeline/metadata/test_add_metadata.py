@@ -18,6 +18,14 @@ class MetadataAdderTest(unittest.TestCase):
   """Unit tests for adding ip metadata."""
 
   def test_annotate_row_ip(self) -> None:
+    """Test adding IP metadata to measurement ips via the broadcast join."""
+    self._assert_annotate_row_ip(broadcast_join=True)
+
+  def test_annotate_row_ip_cogroup_join(self) -> None:
+    """Test adding IP metadata to measurement ips via the CoGroupByKey join."""
+    self._assert_annotate_row_ip(broadcast_join=False)
+
+  def _assert_annotate_row_ip(self, broadcast_join: bool) -> None:
     """Test adding IP metadata to measurement ips."""
     rows = [
         BigqueryRow(
@@ -104,7 +112,8 @@ class MetadataAdderTest(unittest.TestCase):
 
     with TestPipeline() as p:
       rows = p | beam.Create(rows)
-      rows_with_metadata = adder.annotate_row_ip(rows)
+      rows_with_metadata = adder.annotate_row_ip(
+          rows, broadcast_join=broadcast_join)
       beam_test_util.assert_that(rows_with_metadata,
                                  beam_test_util.equal_to(expected))
 
@@ -229,7 +238,9 @@ class MetadataAdderTest(unittest.TestCase):
   def test_annotate_ips_caida(self) -> None:
     """Test merging given IP metadata with given measurements."""
     adder = MetadataAdder(FakeIpMetadataChooserFactory())
-    metadatas = list(adder._annotate_ips('2020-01-01', ['1.1.1.1', '8.8.8.8']))
+    metadatas = list(
+        adder._annotate_ips([('2020-01-01', '1.1.1.1'),
+                             ('2020-01-01', '8.8.8.8')]))
 
     expected_key_1: beam_metadata.DateIpKey = ('2020-01-01', '1.1.1.1')
     expected_value_1 = IpMetadataWithDateKey(
@@ -265,7 +276,7 @@ class MetadataAdderTest(unittest.TestCase):
     # TODO turn back on once maxmind is reenabled.
 
     adder = MetadataAdder(FakeIpMetadataChooserFactory())
-    metadatas = list(adder._annotate_ips('2020-01-01', ['1.1.1.3']))
+    metadatas = list(adder._annotate_ips([('2020-01-01', '1.1.1.3')]))
 
     # Test Maxmind lookup when country data is missing
     # Cloudflare IPs return Australia
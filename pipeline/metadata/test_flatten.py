@@ -19,7 +19,7 @@ class FlattenMeasurementTest(unittest.TestCase):
       rows = list(flattener.process(('test_filename.json', line)))
       self.assertEqual(
           cm.output[0], 'WARNING:root:JSONDecodeError: '
-          'Expecting value: line 1 column 1 (char 0)\n'
+          'unexpected character: line 1 column 1 (char 0)\n'
           'Filename: test_filename.json\ninvalid json\n')
 
     self.assertEqual(len(rows), 0)
@@ -18,7 +18,10 @@ import setuptools
 setuptools.setup(
     name='censoredplanet-analysis',
     version='0.0.1',
-    install_requires=['cryptography==37.0.2', 'geoip2==4.1.0', 'pyasn==1.6.1'],
+    install_requires=[
+        'cryptography==37.0.2', 'geoip2==4.1.0', 'isal==1.1.0',
+        'maxminddb==2.2.0', 'orjson==3.8.3', 'pyasn==1.6.1'
+    ],
     # Add a prefix so absolute import succeeds on workers.
     packages=['pipeline', 'pipeline.metadata'],
     package_dir={
@@ -135,6 +135,26 @@ class PipelineMainTest(unittest.TestCase):
     self.assertFalse(
         beam_tables._between_dates(filename, datetime.date(2020, 5, 12), None))
 
+  def test_filename_matches(self) -> None:
+    """Test matching zipped and unzipped filepaths against allowed names."""
+    allowed_filenames = ['results.json', 'blockpages.json']
+
+    self.assertTrue(
+        beam_tables._filename_matches('path/results.json', allowed_filenames))
+    self.assertTrue(
+        beam_tables._filename_matches('path/results.json.gz',
+                                      allowed_filenames))
+    self.assertTrue(
+        beam_tables._filename_matches(
+            'gs://firehook-scans/satellite/CP_Satellite-2022-05-11-12-00-01/blockpages.json.gz',
+            allowed_filenames))
+    self.assertFalse(
+        beam_tables._filename_matches('path/resolvers.json',
+                                      allowed_filenames))
+    self.assertFalse(
+        beam_tables._filename_matches('path/results.json.tar.gz',
+                                      allowed_filenames))
+
   # pylint: enable=protected-access
 
 